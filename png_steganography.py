@@ -2,8 +2,29 @@ import numpy as np
 import PIL.Image
 import random
 import argparse
-import json
+import os
+import secrets
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from math import ceil, gcd
+
+try:
+    from gmpy2 import is_prime, mpz, powmod
+except ImportError:
+    is_prime = None
+    mpz, powmod = int, pow
+
+# The end of message marker as one byte (0 or 1) per bit
+EOT_BITS = np.unpackbits(np.frombuffer(b"$EOT$", dtype=np.uint8)).tobytes()
+
+# Messages with at least this many blocks under a key of at least this many
+# bits are decrypted in a pool of worker processes
+PARALLEL_MIN_BLOCKS = 64
+PARALLEL_MIN_KEY_BITS = 1024
+
+# Used to discard most prime candidates before running Miller-Rabin
+SMALL_PRIMES = [p for p in range(3, 1000, 2) if all(p % d for d in range(3, int(p ** 0.5) + 1, 2))]
 
 def read_content(path):
     """
@@ -23,7 +44,7 @@ def read_content(path):
         print(f"ERROR: Failed to read from {path}", file=sys.stderr)
         exit()
 
-def hide_message(message, png, output, pubkey, bit_len=1):
+def hide_message(message, png, output, pubkey, bit_len=1, compress_level=1):
     """
     Hides a message inside a PNG image.
 
@@ -33,6 +54,7 @@ def hide_message(message, png, output, pubkey, bit_len=1):
         output (str): Output path for the new image.
         pubkey (tuple): Public key for encryption.
         bit_len (int): Number of bits to alter in each byte (1-4).
+        compress_level (int): zlib compression level for the new image (0-9).
 
     Returns:
         None
@@ -40,16 +62,17 @@ def hide_message(message, png, output, pubkey, bit_len=1):
 
     image = PIL.Image.open(png, "r")
     width, height = image.size
-    img_data = np.array(list(image.getdata()))
-    pixels = img_data.size
-    channels = 4 if image.mode == "RGBA" else 3
+    channels = len(image.getbands())
+    pixels = width * height
 
-    encrypted_message = encrypt(pubkey, message)
-    bit_string = "".join(bin(num)[2:].zfill(32) for num in encrypted_message)
-    bit_string += "".join(f"{ord(c):08b}" for c in "$EOT$")
-    
-    bits_needed = len(bit_string)
-    avai_bits = int((pixels * bit_len) / 4 * 3 if channels == 4 else pixels * bit_len)
+    # Every encrypted block is stored in the smallest number of bytes that can hold n
+    word_len = find_blocksize(pubkey[1]) + 1
+    encrypted_message = b"".join(i.to_bytes(word_len, "big") for i in encrypt(pubkey, message))
+    bits = np.unpackbits(np.frombuffer(encrypted_message, dtype=np.uint8))
+    bits = np.append(bits, np.frombuffer(EOT_BITS, dtype=np.uint8))
+
+    bits_needed = bits.size
+    avai_bits = pixels * 3 * bit_len
 
     print("Image inspected, requirements:")
     print(f"{'Needed:'.ljust(15)} {str(bits_needed).ljust(10)} bits")
@@ -60,20 +83,47 @@ def hide_message(message, png, output, pubkey, bit_len=1):
         print(f"Overflow: {bits_needed-avai_bits} bits", file=sys.stderr)
         exit()
 
-    index = 0
-    for i in range(pixels):
-        if index >= bits_needed:
-            break
-        for j in range(0, 3):
-            if index < bits_needed:
-                tmp = (img_data[i][j] & ~(2 ** bit_len - 1))
-                img_data[i][j] = tmp | int(bit_string[index:(index+bit_len)], 2)
-                index += bit_len
+    if bit_len == 1:
+        values = bits
+    else:
+        # Split the bits into groups of bit_len bits, zero padding the last group
+        bits = np.append(bits, np.zeros(-bits_needed % bit_len, dtype=np.uint8))
+        values = np.packbits(bits.reshape(-1, bit_len), axis=1).ravel() >> (8 - bit_len)
+
+    # Only decode the rows that will actually carry the message
+    rows = ceil(ceil(values.size / 3) / width)
+    img_data = np.array(image.crop((0, 0, width, rows)), dtype=np.uint8).reshape(-1, channels)
 
-    img_data = img_data.reshape((height, width, 4 if image.mode == "RGBA" else 3))
-    result = PIL.Image.fromarray(img_data.astype("uint8"), image.mode)
+    embed_bits(img_data, values, bit_len)
 
-    result.save(png) if not output else result.save(output)
+    image.paste(PIL.Image.frombytes(image.mode, (width, rows), img_data.tobytes()), (0, 0))
+
+    image.save(output or png, format="PNG", compress_level=compress_level)
+
+def embed_bits(img_data, values, bit_len):
+    """
+    Writes values into the lowest bits of the RGB channels, in place.
+
+    Args:
+        img_data (numpy.ndarray): Pixel data with one row per pixel.
+        values (numpy.ndarray): One value per channel, each below 2**bit_len.
+        bit_len (int): Number of bits to alter in each byte (1-4).
+
+    Returns:
+        None
+    """
+
+    mask = ~np.uint8((1 << bit_len) - 1)
+    full, rest = divmod(values.size, 3)
+
+    rgb = img_data[:full, :3]
+    rgb &= mask
+    rgb |= values[:full*3].reshape(-1, 3)
+
+    if rest:
+        tail = img_data[full, :rest]
+        tail &= mask
+        tail |= values[full*3:]
 
 def extract_message(png, seckey, bytes_len=1):
     """
@@ -89,34 +139,110 @@ def extract_message(png, seckey, bytes_len=1):
     """
     
     image = PIL.Image.open(png, "r")
-    img_data = np.array(list(image.getdata()))
-    
-    secret_bits = ""
-    for i in range(img_data.size // 4 if image.mode == "RGBA" else 3):
-        for j in range(3):
-            for k in range(8-bytes_len, 8):
-                secret_bits += format(img_data[i][j], '08b')[k]
+    width, height = image.size
+
+    # Scan the image in strips of rows and stop once the EOT marker shows up
+    step = max(1, 65536 // width)
+    secret_bits = bytearray()
+    end = -1
+    for top in range(0, height, step):
+        strip = image.crop((0, top, width, min(top + step, height)))
+        rgb = np.asarray(strip)[:, :, :3].reshape(-1, 1)
+        start = max(0, len(secret_bits) - len(EOT_BITS) + 1)
+
+        if bytes_len == 1:
+            secret_bits += (rgb & 1).tobytes()
+        else:
+            # Unpack every channel into its 8 bits and keep the lowest bytes_len of them
+            secret_bits += np.unpackbits(rgb, axis=1)[:, 8-bytes_len:].tobytes()
+        end = secret_bits.find(EOT_BITS, start)
+        if end != -1:
+            break
 
-    split_bits = secret_bits.split(''.join(format(ord(c), '08b') for c in "$EOT$"))[0]
-    int_list = [int(split_bits[i:i+32], 2) for i in range(0, len(split_bits), 32)]
+    if end == -1:
+        end = len(secret_bits)
+
+    word_len = find_blocksize(seckey[1]) + 1
+    split_bits = np.frombuffer(secret_bits, dtype=np.uint8, count=end // (8*word_len) * (8*word_len))
+    words = np.packbits(split_bits).tobytes()
+    int_list = [int.from_bytes(words[i:i+word_len], "big") for i in range(0, len(words), word_len)]
 
     return decrypt(seckey, int_list)
 
-def generate_primes():
+def generate_primes(bits=1024):
     """
-    Generates two prime numbers.
+    Generates two distinct prime numbers.
+
+    Args:
+        bits (int): The size of each prime in bits.
 
     Returns:
         tuple: Two randomly generated prime numbers.
     """
-    
-    try:
-        with open("primes.json", "r") as data:
-            data = json.load(data)
-            return random.sample(data, 2)
-    except FileNotFoundError:
-        print("Could not find primes.json, the file is required for generating keypairs", file=sys.stderr)
-        exit()
+
+    p = random_prime(bits)
+    q = random_prime(bits)
+    while q == p:
+        q = random_prime(bits)
+
+    return p, q
+
+def random_prime(bits):
+    """
+    Generates a random prime number with the two highest bits set, so the
+    product of two such primes has exactly twice as many bits.
+
+    Args:
+        bits (int): The size of the prime in bits.
+
+    Returns:
+        int: The prime number.
+    """
+
+    while True:
+        candidate = secrets.randbits(bits) | (3 << (bits-2)) | 1
+        if is_probable_prime(candidate):
+            return candidate
+
+def is_probable_prime(n, rounds=40):
+    """
+    Tests whether a number is prime using the Miller-Rabin test.
+
+    Args:
+        n (int): The number to test.
+        rounds (int): Number of random bases to try.
+
+    Returns:
+        bool: True if n is prime with high probability.
+    """
+
+    if is_prime:
+        return bool(is_prime(n, rounds))
+
+    if n < 2 or n % 2 == 0:
+        return n == 2
+
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for _ in range(rounds):
+        x = pow(secrets.randbelow(n - 3) + 2, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
 
 def text2ints(text, m):
     """
@@ -147,12 +273,16 @@ def ints2text(ints, m):
         str: The converted text.
     """
     
+    data = bytearray(m * len(ints))
     try:
-        return (b"".join(i.to_bytes(m, "big") for i in ints).split(b"\x00")[0]).decode()
+        for k, i in enumerate(ints):
+            data[k*m:(k+1)*m] = i.to_bytes(m, "big")
     except OverflowError:
         print("ERROR: Failed to decrypt the message, verify your decryption key", file=sys.stderr)
         exit()
 
+    return data.partition(b"\x00")[0].decode()
+
 def generate_keypair(p, q):
     """
     Generates a key pair for encryption and decryption.
@@ -168,13 +298,30 @@ def generate_keypair(p, q):
     n = p * q
     phi = (p-1) * (q-1)
 
-    e = random.randint(2, phi-1)
-    while gcd(e, phi) != 1:
+    # The standard small exponent keeps encryption cheap, CRT keeps decryption fast
+    e = 65537
+    while e >= phi or gcd(e, phi) != 1:
         e = random.randint(2, phi-1)
        
-    d = xgcd(e, phi)[1] % phi
+    d = pow(e, -1, phi)
 
-    return (e, n), (d, n)
+    return (e, n), build_seckey(d, n, p, q)
+
+def build_seckey(d, n, p, q):
+    """
+    Builds a private key including the CRT coefficients used by decrypt.
+
+    Args:
+        d (int): The private exponent.
+        n (int): The modulus.
+        p (int): The first prime factor of n.
+        q (int): The second prime factor of n.
+
+    Returns:
+        tuple: The private key (d, n, p, q, dp, dq, qinv).
+    """
+
+    return d, n, p, q, d % (p-1), d % (q-1), pow(q, -1, p)
 
 def encrypt(pubkey, plaintext):
     """
@@ -188,8 +335,11 @@ def encrypt(pubkey, plaintext):
         list: The encrypted message as a list of integers.
     """
     
-    b = find_blocksize(pubkey[1])
-    return [pow(i, pubkey[0], pubkey[1]) for i in text2ints(plaintext, b)]
+    e, n = pubkey
+    blocks = text2ints(plaintext, find_blocksize(n))
+
+    e, n = mpz(e), mpz(n)
+    return [int(powmod(i, e, n)) for i in blocks]
 
 
 def decrypt(seckey, ciphertext):
@@ -204,59 +354,119 @@ def decrypt(seckey, ciphertext):
         str: The decrypted message.
     """
     
-    b = find_blocksize(seckey[1])
-    return ints2text([pow(i, seckey[0], seckey[1]) for i in ciphertext], b)
+    d, n = seckey[:2]
+    b = find_blocksize(n)
 
-def find_blocksize(n):
+    if len(seckey) < 7:
+        d, n = mpz(d), mpz(n)
+        if use_process_pool(ciphertext, n):
+            return ints2text(parallel_map(modexp, ciphertext, d, n), b)
+
+        return ints2text([int(powmod(i, d, n)) for i in ciphertext], b)
+
+    crt = tuple(map(mpz, seckey[2:7]))
+    if use_process_pool(ciphertext, n):
+        return ints2text(parallel_map(crt_modexp, ciphertext, *crt), b)
+
+    return ints2text([crt_modexp(i, *crt) for i in ciphertext], b)
+
+def modexp(base, exp, mod):
     """
-    Finds the block size based on the given number.
+    Raises a block to a power modulo mod.
 
     Args:
-        n (int): The number to find the block size for.
+        base (int): The block.
+        exp (int): The exponent.
+        mod (int): The modulus.
 
     Returns:
-        int: The block size.
+        int: The resulting block.
     """
-    
-    b = 1
-    while pow(2, (8*(b+1)))-1 < n:
-        b += 1
-        
-    return b
 
-def xgcd(a, b):
+    return int(powmod(base, exp, mod))
+
+def crt_modexp(base, p, q, dp, dq, qinv):
     """
-    Extended Euclidean algorithm to calculate the greatest common divisor (GCD).
+    Decrypts a block using the Chinese remainder theorem, which replaces one
+    full-size exponentiation with two half-size ones.
 
     Args:
-        a (int): The first number.
-        b (int): The second number.
+        base (int): The encrypted block.
+        p (int): The first prime factor of the modulus.
+        q (int): The second prime factor of the modulus.
+        dp (int): The private exponent modulo p-1.
+        dq (int): The private exponent modulo q-1.
+        qinv (int): The inverse of q modulo p.
 
     Returns:
-        tuple: GCD and coefficients x, y.
+        int: The decrypted block.
     """
-    
-    if b == 0:
-        g, x, y = a, 1, 0
-    else:
-        g, y, x = xgcd(b, a % b)
-        y -= x * (a // b)
-        
-    return g, x, y
 
-def gcd(a, b):
+    m1 = powmod(base, dp, p)
+    m2 = powmod(base, dq, q)
+    return int(m2 + (qinv * (m1 - m2)) % p * q)
+
+def use_process_pool(blocks, n):
+    """
+    Decides whether the blocks are worth spreading over several processes.
+
+    Args:
+        blocks (list): The blocks to decrypt.
+        n (int): The modulus of the key.
+
+    Returns:
+        bool: True if a process pool should be used.
+    """
+
+    return (len(blocks) >= PARALLEL_MIN_BLOCKS
+            and n.bit_length() >= PARALLEL_MIN_KEY_BITS
+            and usable_cpus() > 1)
+
+def usable_cpus():
+    """
+    Counts the CPUs this process may run on, which can be fewer than the
+    machine has inside a container or under taskset.
+
+    Returns:
+        int: The number of usable CPUs.
+    """
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+def parallel_map(func, blocks, *args):
     """
-    Calculates the greatest common divisor (GCD) of two numbers.
+    Applies a function to every block in a pool of worker processes.
 
     Args:
-        a (int): The first number.
-        b (int): The second number.
+        func (callable): Module level function called as func(block, *args).
+        blocks (list): The blocks to process.
+        *args: Extra arguments passed along with every block.
 
     Returns:
-        int: The GCD of the two numbers.
+        list: The results, in the same order as the blocks.
+    """
+
+    workers = usable_cpus()
+    chunksize = max(1, len(blocks) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, blocks, *(repeat(arg) for arg in args), chunksize=chunksize))
+
+def find_blocksize(n):
+    """
+    Finds the block size based on the given number.
+
+    Args:
+        n (int): The number to find the block size for.
+
+    Returns:
+        int: The block size.
     """
     
-    return a if b == 0 else gcd(b, a % b)
+    # One byte less than is needed to hold n, so every block stays below n
+    return max(1, (n.bit_length() + 7) // 8 - 1)
 
 def setup_argparser():
     """
@@ -289,6 +499,18 @@ def setup_argparser():
                              type=str,
                              help="Output path for the new image")
 
+    hide_parser.add_argument("--key-size",
+                             type=int,
+                             choices=[2 ** i for i in range(5, 13)],
+                             default=2048,
+                             help="Size of the RSA modulus in bits (32-4096)")
+
+    hide_parser.add_argument("--compress-level",
+                             type=int,
+                             choices=range(0, 10),
+                             default=1,
+                             help="zlib compression level for the new image (0-9)")
+
     extract_parser = subparsers.add_parser("extract",
                                            help="Extract a message from a PNG image")
     
@@ -318,14 +540,16 @@ if __name__ == "__main__":
     if args.action == "hide":
         data = read_content(args.data)
         output_path = args.output if args.output else args.source
-        prime1, prime2 = generate_primes()
+        prime1, prime2 = generate_primes(args.key_size // 2)
         pubkey, seckey = generate_keypair(prime1, prime2)
-        hide_message(data, args.source, output_path, pubkey, args.bits)
+        hide_message(data, args.source, output_path, pubkey, args.bits, args.compress_level)
         print()
         print(f"Message was hidden inside {output_path} succesfully!")
-        print(f"Decryption key: {str(seckey[0])}-{str(seckey[1])}")
+        print(f"Decryption key: {'-'.join(str(k) for k in seckey[:4])}")
     elif args.action == "extract":
-        seckey = (int(args.key.split("-")[0]), int(args.key.split("-")[1]))
+        seckey = tuple(int(k) for k in args.key.split("-"))
+        if len(seckey) == 4:
+            seckey = build_seckey(*seckey)
         message = extract_message(args.source, seckey, args.bits)
 
         if args.output: